@@ -1,15 +1,23 @@
-import json
+import asyncio
 import logging
-from ipaddress import IPv4Address, IPv6Address, ip_address
-from typing import Any, Dict, List, Union
-
-import aioredis
+import struct
+import time
+from contextlib import suppress
+from functools import lru_cache
+from itertools import islice, starmap
+from socket import AF_INET, AF_INET6, inet_ntop, inet_pton
+from typing import List, Tuple
+
+import msgspec
 import toml
 from fastapi import FastAPI
 from prometheus_client import Counter, Gauge
-from pydantic import BaseModel, conint, constr, stricturl
+from pydantic import BaseModel, conint, constr, stricturl, validator
+from redis.asyncio import BlockingConnectionPool, Redis
+from redis.exceptions import RedisError
 from starlette.config import Config
 from starlette.requests import Request
+from starlette.responses import Response
 from starlette_exporter import PrometheusMiddleware, handle_metrics
 
 # Config
@@ -17,6 +25,8 @@ config = Config(".env")
 REDIS_URL = config("REDIS_URL", cast=str)
 ANNOUNCE_TTL = config("ANNOUNCE_TTL", cast=int, default=5 * 60)
 PEER_LIMIT = config("PEER_LIMIT", cast=int, default=50)
+REDIS_MAX_CONNECTIONS = config("REDIS_MAX_CONNECTIONS", cast=int, default=64)
+STATISTICS_INTERVAL = config("STATISTICS_INTERVAL", cast=float, default=5)
 
 logger = logging.getLogger(__name__)
 
@@ -34,100 +44,189 @@ UNIQUE_PEERS = Gauge(
 )
 REQUESTS_BY_CLIENT = Counter("lvdiscovery_requests_by_client", "User-Agent breakdown", ["ua"])
 
+
+@lru_cache(maxsize=1024)
+def requests_by_client(ua: str) -> Counter:
+    return REQUESTS_BY_CLIENT.labels(ua=ua)
+
+
 # Some constants
-prefix = "lvdiscovery1:"
-group_prefix = f"{prefix}group:"
-stat_unique_groups = f"{prefix}statistics:unique_groups"
-stat_unique_peers = f"{prefix}statistics:unique_peers"
+prefix = b"lvdiscovery1:"
+group_prefix = prefix + b"group:"
+peers_suffix = b":peers"
+addresses_suffix = b":addresses"
+stat_unique_groups = prefix + b"statistics:unique_groups"
+stat_unique_peers = prefix + b"statistics:unique_peers"
+
+# Stored peer address: IPv6 (or IPv4-mapped) address and port
+ADDRESS_STRUCT = struct.Struct("!16sH")
+IPV4_MAPPED_PREFIX = b"\0" * 10 + b"\xff\xff"
+
+json_encoder = msgspec.json.Encoder()
+
+# Peers of a group live in a sorted set of peer_ids, scored by their expiration time, so Redis keeps one TTL per group
+# instead of one per peer. Their addresses live in a hash next to it, so a re-announce replaces the previous address.
+# Both keys outlive their peers, so that groups nobody announces to anymore eventually vanish.
+# KEYS: peers, addresses, unique groups, unique peers
+# ARGV: now, peer expiration time, group TTL, peer limit, peer_id, packed address, group_id
+ANNOUNCE_SCRIPT = """
+local expired = redis.call("ZRANGEBYSCORE", KEYS[1], "-inf", ARGV[1])
+for _, peer_id in ipairs(expired) do
+    redis.call("HDEL", KEYS[2], peer_id)
+end
+redis.call("ZREMRANGEBYSCORE", KEYS[1], "-inf", ARGV[1])
+redis.call("ZADD", KEYS[1], ARGV[2], ARGV[5])
+redis.call("HSET", KEYS[2], ARGV[5], ARGV[6])
+redis.call("EXPIRE", KEYS[1], ARGV[3])
+redis.call("EXPIRE", KEYS[2], ARGV[3])
+redis.call("SADD", KEYS[3], ARGV[7])
+redis.call("SADD", KEYS[4], ARGV[5])
+local peer_ids = redis.call("ZREVRANGEBYSCORE", KEYS[1], "+inf", ARGV[1], "LIMIT", 0, ARGV[4])
+return {peer_ids, redis.call("HMGET", KEYS[2], unpack(peer_ids))}
+"""
+
+
+def decode_hex(v: str) -> bytes:
+    decoded = bytes.fromhex(v)
+    if len(decoded) * 2 != len(v):  # fromhex() silently skips whitespace
+        raise ValueError("not a hex string")
+    return decoded
 
 
 class Announce(BaseModel):
-    group_id: constr(max_length=128, regex=r"^(?:[0-9a-fA-F]{2})*$")  # sort of info_hash
-    peer_id: constr(max_length=128, regex=r"^(?:[0-9a-fA-F]{2})*$")
+    group_id: constr(max_length=128)  # sort of info_hash
+    peer_id: constr(max_length=128)
     port: conint(gt=0, le=65535)
 
+    _decode_ids = validator("group_id", "peer_id", allow_reuse=True)(decode_hex)
+
 
 class Peer(BaseModel):
     peer_id: constr(max_length=128, regex=r"^(?:[0-9a-fA-F]{2})*$")
     url: stricturl(allowed_schemes={"ws", "wss"})
 
 
+# Decoded peer, as served in announce responses. Peer above documents it in the schema, keep the two in sync
+class PeerRecord(msgspec.Struct, frozen=True):
+    peer_id: str
+    url: str
+
+
 class AnnounceResponse(BaseModel):
     ttl: int
     peers: List[Peer]
 
 
 class Deannounce(BaseModel):
-    group_id: constr(max_length=128, regex=r"^(?:[0-9a-fA-F]{2})*$")  # sort of info_hash
-    peer_id: constr(max_length=128, regex=r"^(?:[0-9a-fA-F]{2})*$")
+    group_id: constr(max_length=128)  # sort of info_hash
+    peer_id: constr(max_length=128)
+
+    _decode_ids = validator("group_id", "peer_id", allow_reuse=True)(decode_hex)
 
 
 @app.on_event("startup")
 async def setup():
-    app.redis_pool = await aioredis.create_redis_pool(REDIS_URL)
+    with open("pyproject.toml", "r") as f:
+        app.version = toml.load(f)["tool"]["poetry"]["version"]
+
+    pool = BlockingConnectionPool.from_url(REDIS_URL, max_connections=REDIS_MAX_CONNECTIONS)
+    app.redis = Redis(connection_pool=pool)
+    app.announce_script = app.redis.register_script(ANNOUNCE_SCRIPT)
+    app.statistics_task = asyncio.create_task(refresh_statistics())
+
+
+@app.on_event("shutdown")
+async def teardown():
+    app.statistics_task.cancel()
+    with suppress(asyncio.CancelledError):
+        await app.statistics_task
+    await app.redis.connection_pool.disconnect()
+
+
+async def refresh_statistics():
+    while True:
+        try:
+            async with app.redis.pipeline(transaction=False) as pipe:
+                pipe.scard(stat_unique_groups)
+                pipe.scard(stat_unique_peers)
+                unique_groups, unique_peers = await pipe.execute()
+            UNIQUE_GROUPS.set(unique_groups)
+            UNIQUE_PEERS.set(unique_peers)
+        except RedisError:
+            logger.exception("Could not refresh statistics")
+        await asyncio.sleep(STATISTICS_INTERVAL)
 
 
 @app.middleware("http")
 async def add_process_time_header(request: Request, call_next):
-    REQUESTS_BY_CLIENT.labels(ua=request.headers["User-Agent"]).inc()
+    requests_by_client(request.headers.get("User-Agent", "")).inc()
     response = await call_next(request)
     return response
 
 
-def normalize_ip(ip: Union[str, IPv4Address, IPv6Address]):
-    if isinstance(ip, str):
-        ip = ip_address(ip)
-    if isinstance(ip, IPv4Address):
-        return ip
-    return ip.ipv4_mapped if ip.ipv4_mapped else ip
+def group_keys(group_id: bytes) -> Tuple[bytes, bytes]:
+    group_key = group_prefix + group_id.hex().encode()
+    return group_key + peers_suffix, group_key + addresses_suffix
+
+
+def pack_ip(host: str) -> bytes:
+    if ":" in host:
+        return inet_pton(AF_INET6, host)
+    return IPV4_MAPPED_PREFIX + inet_pton(AF_INET, host)
+
+
+def pack_address(ip_packed: bytes, port: int) -> bytes:
+    return ADDRESS_STRUCT.pack(ip_packed, port)
+
+
+@lru_cache(maxsize=4096)
+def unpack_peer(peer_id: bytes, address: bytes) -> PeerRecord:
+    # The same records are handed out to every peer of a group, so decoded ones are cached
+    ip_packed, port = ADDRESS_STRUCT.unpack(address)
+    if ip_packed.startswith(IPV4_MAPPED_PREFIX):
+        host = inet_ntop(AF_INET, ip_packed[12:])
+    else:
+        host = f"[{inet_ntop(AF_INET6, ip_packed)}]"
+    return PeerRecord(peer_id.hex(), f"wss://{host}:{port}/")
 
 
 @app.get("/v1/trackerinfo")
 async def trackerinfo():
-    with open("pyproject.toml", "r") as f:
-        t = toml.load(f)
-        return {"version": t["tool"]["poetry"]["version"]}
+    return {"version": app.version}
 
 
 @app.post("/v1/announce", response_model=AnnounceResponse)
 async def announce(ann: Announce, request: Request):
-    ip = normalize_ip(request.client.host)
-    group_id = bytes.fromhex(ann.group_id).hex()
-    peer_id = bytes.fromhex(ann.peer_id).hex()
-
-    peer_prefix = f"{group_prefix}{group_id}:"
-    peer_key = f"{peer_prefix}{peer_id}"
-    await app.redis_pool.set(
-        peer_key, json.dumps({"peer_id": peer_id, "url": f"wss://{str(ip)}:{ann.port}/"}), expire=ANNOUNCE_TTL
+    peers_key, addresses_key = group_keys(ann.group_id)
+    now = time.time()
+
+    peer_ids, addresses = await app.announce_script(
+        keys=[peers_key, addresses_key, stat_unique_groups, stat_unique_peers],
+        args=[
+            now,
+            now + ANNOUNCE_TTL,
+            ANNOUNCE_TTL * 10,
+            PEER_LIMIT + 1,
+            ann.peer_id,
+            pack_address(pack_ip(request.client.host), ann.port),
+            ann.group_id,
+        ],
     )
 
     # Response
-    peers: List[Dict[str, Any]] = []
-    cur = b"0"
-    while cur:
-        cur, keys = await app.redis_pool.scan(cur, match=f"{peer_prefix}*", count=PEER_LIMIT + 1)
-        peers += [y for y in [json.loads(x) for x in await app.redis_pool.mget(*keys)] if y.get("peer_id") != peer_id]
-    peers = peers[0:PEER_LIMIT]
-
-    resp = {"ttl": ANNOUNCE_TTL, "peers": peers}
+    other_peers = ((x, y) for x, y in zip(peer_ids, addresses) if x != ann.peer_id and y is not None)
+    peers: List[PeerRecord] = list(islice(starmap(unpack_peer, other_peers), PEER_LIMIT))
 
-    # Update statistics
-    await app.redis_pool.sadd(stat_unique_groups, bytes.fromhex(group_id))
-    UNIQUE_GROUPS.set(await app.redis_pool.scard(stat_unique_groups))
-
-    await app.redis_pool.sadd(stat_unique_peers, bytes.fromhex(peer_id))
-    UNIQUE_PEERS.set(await app.redis_pool.scard(stat_unique_peers))
-
-    return resp
+    # Returning a Response skips response_model validation; peers come from our own records anyway
+    return Response(json_encoder.encode({"ttl": ANNOUNCE_TTL, "peers": peers}), media_type="application/json")
 
 
 @app.post("/v1/deannounce")
 async def deannounce(ann: Deannounce):
-    group_id = bytes.fromhex(ann.group_id).hex()
-    peer_id = bytes.fromhex(ann.peer_id).hex()
-
-    peer_prefix = f"{group_prefix}{group_id}:"
-    peer_key = f"{peer_prefix}{peer_id}"
-    await app.redis_pool.delete(peer_key)
+    peers_key, addresses_key = group_keys(ann.group_id)
+    async with app.redis.pipeline(transaction=True) as tr:
+        tr.zrem(peers_key, ann.peer_id)
+        tr.hdel(addresses_key, ann.peer_id)
+        await tr.execute()
 
     return {}
@@ -0,0 +1,3 @@
+import os
+
+os.environ.setdefault("REDIS_URL", "redis://localhost")
@@ -0,0 +1,177 @@
+import asyncio
+import logging
+
+import fakeredis
+import pytest
+from prometheus_client import REGISTRY
+from starlette.testclient import TestClient
+
+from services import tracker
+from services.tracker import AnnounceResponse, app, group_keys, pack_address, pack_ip, unpack_peer
+
+CLIENT_HOST = "1.2.3.4"
+GROUP_ID = "ab" * 16
+
+
+@pytest.mark.parametrize(
+    "host, url",
+    [
+        ("1.2.3.4", "wss://1.2.3.4:443/"),
+        ("2001:db8::1", "wss://[2001:db8::1]:443/"),
+        ("::ffff:5.6.7.8", "wss://5.6.7.8:443/"),
+    ],
+)
+def test_peer_round_trip(host, url):
+    peer = unpack_peer(b"\x01\x02", pack_address(pack_ip(host), 443))
+    assert peer.peer_id == "0102"
+    assert peer.url == url
+
+
+def test_peer_round_trip_empty_peer_id():
+    peer = unpack_peer(b"", pack_address(pack_ip("1.2.3.4"), 1))
+    assert peer.peer_id == ""
+    assert peer.url == "wss://1.2.3.4:1/"
+
+
+@pytest.fixture
+def server():
+    return fakeredis.FakeServer()
+
+
+@pytest.fixture
+def client(server):
+    app.redis = fakeredis.FakeAsyncRedis(server=server)
+    app.announce_script = app.redis.register_script(tracker.ANNOUNCE_SCRIPT)
+
+    async def asgi(scope, receive, send):
+        scope["client"] = (CLIENT_HOST, 12345)
+        await app(scope, receive, send)
+
+    return TestClient(asgi)
+
+
+def announce(client, peer_id, port=1000):
+    response = client.post("/v1/announce", json={"group_id": GROUP_ID, "peer_id": peer_id, "port": port})
+    assert response.status_code == 200
+    return response.json()
+
+
+def test_announce_returns_other_peers(client):
+    assert announce(client, "01") == {"ttl": tracker.ANNOUNCE_TTL, "peers": []}
+    assert announce(client, "02", 1002)["peers"] == [{"peer_id": "01", "url": "wss://1.2.3.4:1000/"}]
+
+
+def test_announce_does_not_filter_peer_with_prefixed_id(client):
+    announce(client, "abcd")
+    assert [p["peer_id"] for p in announce(client, "ab")["peers"]] == ["abcd"]
+    assert [p["peer_id"] for p in announce(client, "abcd")["peers"]] == ["ab"]
+
+
+def test_announce_empty_peer_id(client):
+    announce(client, "")
+    assert announce(client, "01")["peers"] == [{"peer_id": "", "url": "wss://1.2.3.4:1000/"}]
+
+
+def test_reannounce_replaces_address(client):
+    announce(client, "01", 1000)
+    announce(client, "01", 1001)
+    assert announce(client, "02")["peers"] == [{"peer_id": "01", "url": "wss://1.2.3.4:1001/"}]
+
+
+def test_announce_returns_freshest_peers_first(client, monkeypatch):
+    monkeypatch.setattr(tracker, "PEER_LIMIT", 1)
+    announce(client, "01")
+    announce(client, "02")
+    assert [p["peer_id"] for p in announce(client, "03")["peers"]] == ["02"]
+
+
+def test_announce_trims_expired_peers(client, server):
+    redis = fakeredis.FakeRedis(server=server)
+    peers_key, addresses_key = group_keys(bytes.fromhex(GROUP_ID))
+    announce(client, "01")
+    redis.zadd(peers_key, {b"\x01": 0})
+
+    assert announce(client, "02")["peers"] == []
+    assert redis.zrange(peers_key, 0, -1) == [b"\x02"]
+    assert redis.hkeys(addresses_key) == [b"\x02"]
+
+
+def test_deannounce(client, server):
+    redis = fakeredis.FakeRedis(server=server)
+    peers_key, addresses_key = group_keys(bytes.fromhex(GROUP_ID))
+    announce(client, "01")
+    announce(client, "02")
+
+    response = client.post("/v1/deannounce", json={"group_id": GROUP_ID, "peer_id": "01"})
+    assert response.status_code == 200
+    assert redis.zrange(peers_key, 0, -1) == [b"\x02"]
+    assert redis.hkeys(addresses_key) == [b"\x02"]
+    assert announce(client, "03")["peers"] == [{"peer_id": "02", "url": "wss://1.2.3.4:1000/"}]
+
+
+def test_announce_rejects_invalid_ids(client):
+    for peer_id in ("zz", "abc", "ab cd"):
+        response = client.post("/v1/announce", json={"group_id": GROUP_ID, "peer_id": peer_id, "port": 1})
+        assert response.status_code == 422
+
+
+def test_metrics_with_non_ip_client():
+    # Starlette's TestClient reports "testclient" as the client host
+    response = TestClient(app).get("/metrics")
+    assert response.status_code == 200
+
+
+def run_statistics_once(server, monkeypatch):
+    async def stop(delay):
+        raise asyncio.CancelledError
+
+    async def run():
+        app.redis = fakeredis.FakeAsyncRedis(server=server)
+        await tracker.refresh_statistics()
+
+    monkeypatch.setattr(tracker.asyncio, "sleep", stop)
+    loop = asyncio.new_event_loop()  # leaves the current loop to TestClient
+    try:
+        with pytest.raises(asyncio.CancelledError):
+            loop.run_until_complete(run())
+    finally:
+        loop.close()
+
+
+def test_refresh_statistics(server, monkeypatch):
+    redis = fakeredis.FakeRedis(server=server)
+    redis.sadd(tracker.stat_unique_groups, b"\x01", b"\x02")
+    redis.sadd(tracker.stat_unique_peers, b"\x01", b"\x02", b"\x03")
+
+    run_statistics_once(server, monkeypatch)
+    assert REGISTRY.get_sample_value("lvdiscovery_unique_groups") == 2
+    assert REGISTRY.get_sample_value("lvdiscovery_unique_peers") == 3
+
+
+def test_refresh_statistics_survives_redis_errors(server, monkeypatch, caplog):
+    server.connected = False
+
+    with caplog.at_level(logging.ERROR):
+        run_statistics_once(server, monkeypatch)
+    assert "Could not refresh statistics" in caplog.text
+
+
+def test_trackerinfo_reports_project_version(tmp_path, monkeypatch):
+    (tmp_path / "pyproject.toml").write_text('[tool.poetry]\nversion = "1.2.3"\n')
+    monkeypatch.chdir(tmp_path)
+
+    with TestClient(app) as client:  # runs startup, which reads the version
+        assert client.get("/v1/trackerinfo").json() == {"version": "1.2.3"}
+
+
+def test_announce_response_matches_schema(client):
+    announce(client, "01")
+    response = client.post("/v1/announce", json={"group_id": GROUP_ID, "peer_id": "02", "port": 1})
+    parsed = AnnounceResponse.parse_raw(response.content)
+    assert parsed.dict() == response.json()
+
+
+def test_request_without_user_agent(client):
+    response = client.get("/v1/trackerinfo", headers={"User-Agent": None})
+    assert "user-agent" not in {k.lower() for k in response.request.headers}
+    assert response.status_code == 200